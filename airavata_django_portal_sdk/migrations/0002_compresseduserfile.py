@@ -0,0 +1,30 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airavata_django_portal_sdk', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompressedUserFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=64)),
+                ('file_path', models.TextField()),
+                ('codec', models.CharField(max_length=16)),
+                ('original_size', models.BigIntegerField()),
+                ('compressed_size', models.BigIntegerField()),
+                ('frame_size', models.IntegerField()),
+                ('frame_offsets', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='compresseduserfile',
+            index=models.Index(fields=['username'], name='compressedfile_username_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airavata_django_portal_sdk', '0002_compresseduserfile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataProductOutbox',
+            fields=[
+                ('provisional_uri', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('username', models.CharField(max_length=64)),
+                ('file_path', models.TextField()),
+                ('data_product', models.BinaryField()),
+                ('product_uri', models.CharField(max_length=255, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_time', models.DateTimeField()),
+                ('last_error', models.TextField(blank=True)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dataproductoutbox',
+            index=models.Index(fields=['product_uri', 'next_attempt_time'], name='outbox_pending_idx'),
+        ),
+    ]
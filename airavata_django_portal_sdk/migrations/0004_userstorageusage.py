@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airavata_django_portal_sdk', '0003_dataproductoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStorageUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=64)),
+                ('directory', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('username', 'directory')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airavata_django_portal_sdk', '0004_userstorageusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataproductoutbox',
+            name='registered_time',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
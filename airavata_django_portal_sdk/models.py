@@ -13,3 +13,67 @@ class UserFiles(models.Model):
             # TEXT column which is required to create an index
             models.Index(fields=['username'], name='userfiles_username_idx')
         ]
+
+
+class CompressedUserFile(models.Model):
+    """Index of user files that have been compressed at rest.
+
+    The file at file_path holds a sequence of independently compressed
+    frames, each holding frame_size bytes of the original file (except the
+    last one). frame_offsets is a JSON list of the offsets where each frame
+    starts in the compressed file, followed by the compressed file's size.
+    """
+    username = models.CharField(max_length=64)
+    file_path = models.TextField()
+    codec = models.CharField(max_length=16)
+    original_size = models.BigIntegerField()
+    compressed_size = models.BigIntegerField()
+    frame_size = models.IntegerField()
+    frame_offsets = models.TextField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['username'],
+                         name='compressedfile_username_idx')
+        ]
+
+
+class DataProductOutbox(models.Model):
+    """Data products waiting to be registered with the Airavata API.
+
+    A UserFiles record with provisional_uri as its file_dpu is created at
+    the same time and is replaced with one for product_uri once the data
+    product is registered. Entries that still aren't registered after the
+    maximum number of attempts are left in place for an administrator to
+    look at.
+    """
+    provisional_uri = models.CharField(max_length=255, primary_key=True)
+    username = models.CharField(max_length=64)
+    file_path = models.TextField()
+    data_product = models.BinaryField()
+    product_uri = models.CharField(max_length=255, null=True)
+    registered_time = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_time = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product_uri', 'next_attempt_time'],
+                         name='outbox_pending_idx')
+        ]
+
+
+class UserStorageUsage(models.Model):
+    """Bytes used by a user's files in a top-level directory of their storage.
+
+    directory is the name of the top-level directory, or the empty string
+    for files directly in the user's storage directory.
+    """
+    username = models.CharField(max_length=64)
+    directory = models.CharField(max_length=255)
+    size = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('username', 'directory')
@@ -0,0 +1,35 @@
+import copy
+import uuid
+
+from airavata.api.error.ttypes import AiravataErrorType, AiravataSystemException
+
+
+class LocalAiravataClient:
+    """In-memory stand-in for the Airavata API client, for use in tests.
+
+    Implements the data product methods used by this SDK. Set available to
+    False to simulate the Airavata API being down.
+    """
+
+    def __init__(self):
+        self.available = True
+        self.data_products = {}
+
+    def registerDataProduct(self, authz_token, data_product):
+        self._check_available()
+        product_uri = "airavata-dp://{}".format(uuid.uuid4())
+        registered = copy.deepcopy(data_product)
+        registered.productUri = product_uri
+        self.data_products[product_uri] = registered
+        return product_uri
+
+    def getDataProduct(self, authz_token, product_uri):
+        self._check_available()
+        return copy.deepcopy(self.data_products[product_uri])
+
+    def _check_available(self):
+        if not self.available:
+            raise AiravataSystemException(
+                airavataErrorType=AiravataErrorType.INTERNAL_ERROR,
+                message="Airavata API is unavailable",
+            )
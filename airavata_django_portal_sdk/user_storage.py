@@ -1,14 +1,36 @@
+import bisect
+import collections
+import datetime
+import gzip
+import hashlib
+import io
+import json
 import logging
 import mimetypes
 import os
 import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 from django.apps import apps
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist, SuspiciousFileOperation
+from django.core.cache import caches
+from django.core.exceptions import (
+    ImproperlyConfigured,
+    ObjectDoesNotExist,
+    SuspiciousFileOperation,
+)
+from django.core.files import File
 from django.core.files.move import file_move_safe
 from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from thrift import TSerialization
 
 from airavata.model.data.replica.ttypes import (DataProductModel,
                                                 DataProductType,
@@ -21,6 +43,7 @@ import copy
 logger = logging.getLogger(__name__)
 
 TMP_INPUT_FILE_UPLOAD_DIR = "tmp"
+PROVISIONAL_DATA_PRODUCT_URI_PREFIX = "airavata-dp-provisional://"
 
 
 def save(request, path, file, name=None, content_type=None):
@@ -81,10 +104,13 @@ def is_input_file(request, data_product):
 def move_input_file(request, data_product, path):
     source_path = _get_replica_filepath(data_product)
     file_name = data_product.productName
-    full_path = _Datastore().move(
+    datastore = _Datastore()
+    # Replica paths may predate a change of user directory layout
+    source_full_path = datastore.path(data_product.ownerName, source_path)
+    full_path = datastore.move(
         data_product.ownerName, source_path, request.user.username, path, file_name
     )
-    _delete_data_product(data_product.ownerName, source_path)
+    _delete_data_product(data_product.ownerName, source_full_path)
     data_product = _save_copy_of_data_product(request, full_path, data_product)
     return data_product
 
@@ -110,6 +136,96 @@ def open_file(request, data_product):
     return _Datastore().open(data_product.ownerName, path)
 
 
+def preview_head(request, data_product, lines=10, max_bytes=1048576):
+    """Return the first lines of the replica's file as a list of strings.
+
+    Only as much of the file as is needed is read, so this is cheap even for
+    very large files. Line endings are stripped and undecodable bytes are
+    replaced. At most max_bytes are read, so fewer lines may be returned and
+    the last one may be cut short if lines are very long.
+    """
+    path = _get_replica_filepath(data_product)
+    with _Datastore().open(data_product.ownerName, path) as f:
+        return _read_lines_forward(f, 0, lines, max_bytes)
+
+
+def preview_tail(request, data_product, lines=10, max_bytes=1048576):
+    """Return the last lines of the replica's file as a list of strings.
+
+    The file is read backwards from its end, so this is cheap even for very
+    large files. Only the last max_bytes of the file are considered, so fewer
+    lines may be returned and the first one may be cut short.
+    """
+    path = _get_replica_filepath(data_product)
+    datastore = _Datastore()
+    size = datastore.size(data_product.ownerName, path)
+    with datastore.open(data_product.ownerName, path) as f:
+        start = _find_tail_offset(f, size, lines, max_bytes)
+        return _read_lines_forward(f, start, lines, max_bytes)
+
+
+def preview_lines(request, data_product, start, stop, max_bytes=1048576):
+    """Return lines start up to but not including stop (0-based).
+
+    The first call for a file builds a sparse index of line offsets which is
+    cached per file. If the file has only grown since, just the new part is
+    indexed, otherwise the index is rebuilt. Subsequent calls only read the
+    part of the file around the requested lines. At most max_bytes of lines
+    are read, so fewer lines may be returned and the last one may be cut
+    short.
+    """
+    if start < 0 or stop < start:
+        raise ValueError("Invalid line range: {}-{}".format(start, stop))
+    path = _get_replica_filepath(data_product)
+    datastore = _Datastore()
+    username = data_product.ownerName
+    with datastore.open(username, path) as f:
+        line_index = _get_line_index(
+            datastore.path(username, path),
+            datastore.size(username, path),
+            datastore.get_modified_time(username, path),
+            f,
+        )
+        offset = line_index.find_line_offset(f, start)
+        if offset is None:
+            return []
+        return _read_lines_forward(f, offset, stop - start, max_bytes)
+
+
+def preview_follow(request, data_product, cursor=None, lines=10, max_bytes=1048576):
+    """Incrementally read lines appended to the replica's file, like tail -f.
+
+    Returns a tuple of (lines, cursor). Pass cursor=None initially to get the
+    last complete lines of the file, then pass back the returned cursor to
+    get only the complete lines written since. At most max_bytes are read
+    per call; lines longer than that are returned in pieces. If the file has
+    been truncated the cursor is reset to the beginning.
+    """
+    path = _get_replica_filepath(data_product)
+    datastore = _Datastore()
+    size = datastore.size(data_product.ownerName, path)
+    with datastore.open(data_product.ownerName, path) as f:
+        if cursor is None:
+            # Leave out a partially written last line, it will be returned
+            # once it is complete
+            end = _find_last_line_end(f, size, max_bytes)
+            start = _find_tail_offset(f, end, lines, max_bytes)
+            f.seek(start)
+            return _decode_lines(f.read(end - start)), end
+        if cursor > size:
+            cursor = 0
+        f.seek(cursor)
+        data = f.read(min(max_bytes, size - cursor))
+    end = data.rfind(b"\n") + 1
+    if end == 0 and len(data) < max_bytes:
+        # Wait for the rest of the line to be written
+        return [], cursor
+    elif end == 0:
+        # A single line longer than max_bytes, return it in pieces
+        end = len(data)
+    return _decode_lines(data[:end]), cursor + end
+
+
 def exists(request, data_product):
     "Return True if replica for data_product exists in user storage."
     path = _get_replica_filepath(data_product)
@@ -140,8 +256,11 @@ def delete(request, data_product):
     "Delete replica for data product in this data store."
     path = _get_replica_filepath(data_product)
     try:
-        _Datastore().delete(data_product.ownerName, path)
-        _delete_data_product(data_product.ownerName, path)
+        datastore = _Datastore()
+        # Replica paths may predate a change of user directory layout
+        full_path = datastore.path(data_product.ownerName, path)
+        datastore.delete(data_product.ownerName, path)
+        _delete_data_product(data_product.ownerName, full_path)
     except Exception as e:
         logger.exception(
             "Unable to delete file {} for data product uri {}".format(
@@ -152,54 +271,113 @@ def delete(request, data_product):
 
 
 def listdir(request, path):
-    """Return a tuple of two lists, one for directories, the second for files."""
+    """Return a tuple of two lists, one for directories, the second for files.
+
+    If settings.GATEWAY_DATA_STORE_LISTING_CACHE names a cache in
+    settings.CACHES, the names and data product URIs in listings are cached
+    there and shared by all processes using that cache. Cached listings are
+    invalidated by any change made through this module and by changes to the
+    directory's modification time. Sizes and times are always read from the
+    filesystem so they reflect changes made outside of this module, such as
+    job outputs.
+    """
     datastore = _Datastore()
-    if datastore.dir_exists(request.user.username, path):
-        directories, files = datastore.list_user_dir(request.user.username, path)
-        directories_data = []
-        for d in directories:
-            dpath = os.path.join(path, d)
-            created_time = datastore.get_created_time(request.user.username, dpath)
-            size = datastore.size(request.user.username, dpath)
-            directories_data.append(
-                {
-                    "name": d,
-                    "path": dpath,
-                    "created_time": created_time,
-                    "size": size,
-                    "hidden": dpath == TMP_INPUT_FILE_UPLOAD_DIR,
-                }
-            )
-        files_data = []
-        for f in files:
-            user_rel_path = os.path.join(path, f)
-            created_time = datastore.get_created_time(
-                request.user.username, user_rel_path
-            )
-            size = datastore.size(request.user.username, user_rel_path)
-            full_path = datastore.path(request.user.username, user_rel_path)
-            data_product_uri = _get_data_product_uri(request, full_path)
-            files_data.append(
-                {
-                    "name": f,
-                    "path": user_rel_path,
-                    "data-product-uri": data_product_uri,
-                    "created_time": created_time,
-                    "size": size,
-                    "hidden": False,
-                }
+    username = request.user.username
+    if datastore.dir_exists(username, path):
+        full_path = datastore.path(username, path)
+        listing_cache = _get_listing_cache()
+        if listing_cache is None:
+            directories, files = _list_entries(request, datastore, path)
+            return _listdir(request, datastore, path, directories, files)
+        generation_key, listing_key = _get_listing_cache_keys(username, full_path)
+        # Read generation before listing so that a concurrent change causes
+        # the listing to be stored with an already outdated generation
+        generation = _get_listing_generation(listing_cache, generation_key)
+        dir_mtime = os.stat(full_path).st_mtime_ns
+        cached = listing_cache.get(listing_key)
+        if cached is not None and cached[:2] == (generation, dir_mtime):
+            directories, files = cached[2]
+        else:
+            directories, files = _list_entries(request, datastore, path)
+            listing_cache.set(
+                listing_key, (generation, dir_mtime, (directories, files))
             )
-        return directories_data, files_data
+        return _listdir(request, datastore, path, directories, files)
     else:
         raise ObjectDoesNotExist("User storage path does not exist")
 
 
+def _list_entries(request, datastore, path):
+    """Return directory names and (name, data product URI) for files in path."""
+    directories, files = datastore.list_user_dir(request.user.username, path)
+    files = [
+        (
+            f,
+            _get_data_product_uri(
+                request, datastore.path(request.user.username, os.path.join(path, f))
+            ),
+        )
+        for f in files
+    ]
+    return directories, files
+
+
+def _listdir(request, datastore, path, directories, files):
+    # Load the compression index once rather than looking up each entry
+    datastore._get_compressed_files(request.user.username)
+    directories_data = []
+    for d in directories:
+        dpath = os.path.join(path, d)
+        created_time = datastore.get_created_time(request.user.username, dpath)
+        size = datastore.size(request.user.username, dpath)
+        directories_data.append(
+            {
+                "name": d,
+                "path": dpath,
+                "created_time": created_time,
+                "size": size,
+                "hidden": dpath == TMP_INPUT_FILE_UPLOAD_DIR,
+            }
+        )
+    files_data = []
+    for f, data_product_uri in files:
+        user_rel_path = os.path.join(path, f)
+        created_time = datastore.get_created_time(
+            request.user.username, user_rel_path
+        )
+        size = datastore.size(request.user.username, user_rel_path)
+        files_data.append(
+            {
+                "name": f,
+                "path": user_rel_path,
+                "data-product-uri": data_product_uri,
+                "created_time": created_time,
+                "size": size,
+                "hidden": False,
+            }
+        )
+    return directories_data, files_data
+
+
 def get_experiment_dir(request, project_name=None, experiment_name=None, path=None):
     return _Datastore().get_experiment_dir(
         request.user.username, project_name, experiment_name, path
     )
 
 
+def get_experiment_dirs(request, project_name, experiment_names):
+    """Create a directory for each experiment and return their full paths.
+
+    Equivalent to calling get_experiment_dir for each experiment name, but
+    the project directory is listed only once and the experiment directories
+    are created in parallel, which is much faster for large parameter
+    sweeps. The returned paths are in the same order as experiment_names.
+    """
+    return _Datastore().get_experiment_dirs(
+        request.user.username, project_name, experiment_names
+    )
+
+
 def create_user_dir(request, path):
     return _Datastore().create_user_dir(request.user.username, path)
 
@@ -207,6 +385,409 @@ def create_user_dir(request, path):
 def get_rel_path(request, path):
     return _Datastore().rel_path(request.user.username, path)
 
+
+def cleanup_tmp_input_files(
+    max_age=None, max_size=None, is_referenced=None, dry_run=False, max_workers=8
+):
+    """Remove abandoned files from every user's input file staging area.
+
+    A file is removed if it is older than max_age (a datetime.timedelta) or,
+    when the user's staging area holds more than max_size bytes, if it is
+    one of the oldest files that need to go to bring it back under
+    max_size. is_referenced, if given, is called with a username and a list
+    of full paths and should return the paths that must be kept, for
+    example because a pending experiment still uses them as inputs.
+
+    Users' staging areas are scanned and cleaned in parallel. When dry_run
+    is True nothing is deleted. Returns a dict mapping username to the list
+    of full paths that were (or would be) removed.
+    """
+    datastore = _Datastore()
+    max_age_seconds = max_age.total_seconds() if max_age is not None else None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scans = executor.map(
+            lambda username: (username, datastore.scan_tmp_input_files(username)),
+            datastore.list_usernames(),
+        )
+        removals = {}
+        now = time.time()
+        for username, entries in scans:
+            if not entries:
+                continue
+            referenced = set()
+            if is_referenced is not None:
+                referenced = set(
+                    is_referenced(username, [entry.path for entry in entries])
+                )
+            full_paths = _select_tmp_input_files_to_remove(
+                entries, referenced, now, max_age_seconds, max_size
+            )
+            if full_paths:
+                removals[username] = full_paths
+    if not dry_run:
+        for username, full_paths in removals.items():
+            datastore.delete_files(username, full_paths, max_workers=max_workers)
+            _delete_data_products(username, full_paths)
+    return removals
+
+
+def compress_cold_files(
+    min_age=datetime.timedelta(days=7),
+    min_size=1024 * 1024,
+    usernames=None,
+    max_workers=4,
+):
+    """Compress text files that haven't been modified for at least min_age.
+
+    Requires settings.GATEWAY_DATA_STORE_COMPRESSION_ENABLED, which must
+    remain enabled for as long as there are compressed files. Compressed
+    files keep their name, permissions and modification time and are
+    transparently decompressed by open_file, listdir, size, etc. Files
+    smaller than min_size, files in the input file staging area and files
+    that don't compress well are left as is. Only the given usernames are
+    processed if provided, otherwise all users are.
+
+    Returns a dict mapping username to the list of full paths compressed.
+    """
+    if not _compression_enabled():
+        raise Exception("GATEWAY_DATA_STORE_COMPRESSION_ENABLED is not set")
+    datastore = _Datastore()
+    if usernames is None:
+        usernames = datastore.list_usernames()
+    compressed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for username in usernames:
+            candidates = datastore.find_cold_text_files(
+                username, min_age.total_seconds(), min_size
+            )
+            full_paths = []
+            # Compress in worker threads but record in the index from this
+            # thread, as soon as each file has been replaced
+            for compressed_file in executor.map(
+                lambda full_path: datastore.compress_file(username, full_path),
+                candidates,
+            ):
+                if compressed_file is not None:
+                    datastore.add_compressed_file(compressed_file)
+                    full_paths.append(compressed_file.file_path)
+            if full_paths:
+                compressed[username] = full_paths
+    return compressed
+
+
+def migrate_user_layout(usernames=None, batch_size=500):
+    """Move user directories from the flat layout to the configured layout.
+
+    Set settings.GATEWAY_DATA_STORE_LAYOUT first; users that haven't been
+    migrated yet are still found in their old directory, so this can run
+    while the portal is online. Each user's directory is moved with a
+    single rename and the user's UserFiles (and CompressedUserFile) paths
+    are rewritten in batches in the same transaction. Replica paths already
+    registered with Airavata keep working since old paths are mapped to the
+    new location. Returns the list of usernames migrated.
+    """
+    datastore = _Datastore()
+    layout = _get_user_dir_layout()
+    if isinstance(layout, _FlatLayout):
+        return []
+    if usernames is None:
+        usernames = layout.list_unmigrated_usernames(datastore.directory)
+    migrated = []
+    for username in usernames:
+        if datastore.migrate_user_dir(username, layout, batch_size=batch_size):
+            migrated.append(username)
+    return migrated
+
+
+def register_pending_data_products(
+    airavata_client,
+    authz_token,
+    batch_size=100,
+    retry_delay=datetime.timedelta(seconds=30),
+    max_retry_delay=datetime.timedelta(hours=1),
+    max_attempts=20,
+    retention=datetime.timedelta(days=7),
+):
+    """Register a batch of data products saved in write-behind mode.
+
+    With settings.GATEWAY_DATA_PRODUCT_REGISTRATION_WRITE_BEHIND, functions
+    like save return a data product with a provisional URI instead of
+    waiting for the Airavata API. This should be called periodically from a
+    background worker to register them and swap the real data product URI
+    in. Failed registrations are retried with exponential backoff starting
+    at retry_delay, up to max_attempts times, after which the entry is kept
+    but no longer retried. Entries registered more than retention ago are
+    purged, after which their provisional URIs no longer resolve. Several
+    workers may run at the same time.
+
+    Returns the number of data products registered.
+    """
+    from airavata_django_portal_sdk import models
+    now = timezone.now()
+    models.DataProductOutbox.objects.filter(
+        registered_time__lt=now - retention
+    ).delete()
+    pending = list(
+        models.DataProductOutbox.objects.filter(
+            product_uri__isnull=True,
+            attempts__lt=max_attempts,
+            next_attempt_time__lte=now,
+        ).order_by("next_attempt_time")[:batch_size]
+    )
+    registered = 0
+    for entry in pending:
+        # Claim entry by pushing its next attempt back, which fails if another
+        # worker already claimed it
+        claim_time = now + max_retry_delay
+        claimed = models.DataProductOutbox.objects.filter(
+            provisional_uri=entry.provisional_uri,
+            next_attempt_time=entry.next_attempt_time,
+        ).update(next_attempt_time=claim_time)
+        if not claimed:
+            continue
+        user_files = models.UserFiles.objects.filter(file_dpu=entry.provisional_uri)
+        if not user_files.exists():
+            # File was deleted before it was registered
+            entry.delete()
+            continue
+        data_product = TSerialization.deserialize(
+            DataProductModel(), bytes(entry.data_product)
+        )
+        try:
+            product_uri = airavata_client.registerDataProduct(
+                authz_token, data_product
+            )
+        except Exception as e:
+            logger.warning(
+                "Failed to register data product for {}: {}".format(
+                    entry.file_path, str(e)
+                )
+            )
+            entry.attempts += 1
+            if entry.attempts >= max_attempts:
+                logger.error(
+                    "Giving up on registering data product for {} after {} "
+                    "attempts".format(entry.file_path, entry.attempts)
+                )
+            # Cap the exponent, a large multiplier overflows timedelta
+            delay = min(
+                retry_delay * 2 ** min(entry.attempts - 1, 20), max_retry_delay
+            )
+            entry.next_attempt_time = timezone.now() + delay
+            entry.last_error = str(e)
+            entry.save()
+            continue
+        with transaction.atomic():
+            # file_dpu is the primary key so create a new record
+            for user_file in user_files:
+                user_file.delete()
+                models.UserFiles.objects.create(
+                    username=user_file.username,
+                    file_path=user_file.file_path,
+                    file_dpu=product_uri,
+                )
+            entry.product_uri = product_uri
+            entry.registered_time = timezone.now()
+            entry.attempts += 1
+            entry.last_error = ""
+            entry.save()
+        _invalidate_listing_cache(entry.username)
+        registered += 1
+    return registered
+
+
+def resolve_data_product_uri(request, product_uri):
+    """Return the registered data product URI for a possibly provisional one.
+
+    If product_uri is a provisional URI (see register_pending_data_products)
+    returns the real data product URI if the data product has since been
+    registered, otherwise (or if the registration has been purged) None. Any
+    other product_uri is returned as is.
+    """
+    if not product_uri.startswith(PROVISIONAL_DATA_PRODUCT_URI_PREFIX):
+        return product_uri
+    from airavata_django_portal_sdk import models
+    entry = models.DataProductOutbox.objects.filter(
+        provisional_uri=product_uri
+    ).first()
+    return entry.product_uri if entry is not None else None
+
+
+def get_storage_usage(request):
+    """Return dict of the user's top-level directories to bytes used.
+
+    Files directly in the user's storage directory are counted under the
+    empty string. Usage comes from a ledger that is updated by every change
+    made through this module, so this doesn't need to walk the user's files.
+    Run reconcile_storage_usage periodically (and once when the ledger is
+    first introduced) to pick up changes made outside of this module.
+    """
+    from airavata_django_portal_sdk import models
+    return {
+        usage.directory: usage.size
+        for usage in models.UserStorageUsage.objects.filter(
+            username=request.user.username
+        )
+        if usage.size != 0
+    }
+
+
+def reconcile_storage_usage(usernames=None, max_workers=8):
+    """Reset users' storage usage ledger from what is on the filesystem.
+
+    Users' storage directories are walked in parallel. Changes made while a
+    user's directory is being walked may be missed until the next run.
+    """
+    from airavata_django_portal_sdk import models
+    datastore = _Datastore()
+    if usernames is None:
+        usernames = datastore.list_usernames()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        usages = executor.map(
+            lambda username: (username, datastore.get_storage_usage_by_dir(username)),
+            usernames,
+        )
+        for username, usage in usages:
+            with transaction.atomic():
+                models.UserStorageUsage.objects.filter(username=username).delete()
+                models.UserStorageUsage.objects.bulk_create(
+                    [
+                        models.UserStorageUsage(
+                            username=username, directory=directory, size=size
+                        )
+                        for directory, size in usage.items()
+                    ]
+                )
+
+
+class StorageQuotaExceeded(Exception):
+    """Raised when a write would exceed settings.GATEWAY_USER_STORAGE_QUOTA."""
+
+
+def _check_storage_quota(username, size):
+    """Raise StorageQuotaExceeded if writing size bytes would exceed quota."""
+    quota = getattr(settings, "GATEWAY_USER_STORAGE_QUOTA", None)
+    if quota is None or size is None:
+        return
+    from airavata_django_portal_sdk import models
+    usage = (
+        models.UserStorageUsage.objects.filter(username=username).aggregate(
+            total=Sum("size")
+        )["total"]
+        or 0
+    )
+    if usage + size > quota:
+        raise StorageQuotaExceeded(
+            "Writing {} bytes would exceed storage quota of {} bytes for user {} "
+            "(currently using {} bytes)".format(size, quota, username, usage)
+        )
+
+
+def _update_storage_usage(username, directory, delta):
+    """Atomically add delta bytes to user's usage for top-level directory."""
+    if delta == 0:
+        return
+    from airavata_django_portal_sdk import models
+    usage = models.UserStorageUsage.objects.filter(
+        username=username, directory=directory
+    )
+    if usage.update(size=F("size") + delta):
+        return
+    try:
+        with transaction.atomic():
+            models.UserStorageUsage.objects.create(
+                username=username, directory=directory, size=delta
+            )
+    except IntegrityError:
+        # Created concurrently
+        usage.update(size=F("size") + delta)
+
+
+def _get_file_size(file):
+    size = getattr(file, "size", None)
+    if size is None and hasattr(file, "seek") and hasattr(file, "tell"):
+        position = file.tell()
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+        file.seek(position)
+    return size
+
+
+def _select_tmp_input_files_to_remove(
+    entries, referenced, now, max_age_seconds=None, max_size=None
+):
+    """Apply the age and size policy to a user's staging area entries."""
+    remove = []
+    keep = []
+    # Oldest first so that the size policy evicts the oldest files first
+    for entry in sorted(entries, key=lambda e: e.mtime):
+        if entry.path in referenced:
+            keep.append(entry)
+        elif max_age_seconds is not None and now - entry.mtime > max_age_seconds:
+            remove.append(entry)
+        else:
+            keep.append(entry)
+    if max_size is not None:
+        total_size = sum(entry.size for entry in keep)
+        for entry in list(keep):
+            if total_size <= max_size:
+                break
+            if entry.path not in referenced:
+                keep.remove(entry)
+                remove.append(entry)
+                total_size -= entry.size
+    return [entry.path for entry in remove]
+
+
+def _get_listing_cache():
+    cache_alias = getattr(settings, "GATEWAY_DATA_STORE_LISTING_CACHE", None)
+    if cache_alias is None:
+        return None
+    return caches[cache_alias]
+
+
+def _get_listing_cache_keys(username, full_path=None):
+    """Return cache keys for user's listing generation and full_path listing."""
+    # Hash the username and path to keep keys short and free of characters
+    # that some cache backends don't allow
+    user_hash = hashlib.sha1(username.encode()).hexdigest()
+    generation_key = "airavata-django-portal-sdk:listdir-generation:{}".format(
+        user_hash
+    )
+    if full_path is None:
+        return generation_key, None
+    listing_key = "airavata-django-portal-sdk:listdir:{}:{}".format(
+        user_hash, hashlib.sha1(full_path.encode()).hexdigest()
+    )
+    return generation_key, listing_key
+
+
+def _invalidate_listing_cache(username):
+    """Invalidate all of user's cached listings by bumping their generation."""
+    listing_cache = _get_listing_cache()
+    if listing_cache is None:
+        return
+    generation_key, _ = _get_listing_cache_keys(username)
+    try:
+        listing_cache.incr(generation_key)
+    except ValueError:
+        # Generation doesn't exist yet (or was evicted). A fresh seed is also
+        # a new generation. If another process creates it first, add() fails
+        # and we increment theirs instead.
+        if not listing_cache.add(generation_key, time.time_ns(), timeout=None):
+            listing_cache.incr(generation_key)
+
+
+def _get_listing_generation(listing_cache, generation_key):
+    generation = listing_cache.get(generation_key)
+    if generation is None:
+        # Seed with a value that can't repeat an evicted generation, so that
+        # listings cached before the eviction aren't considered current
+        listing_cache.add(generation_key, time.time_ns(), timeout=None)
+        generation = listing_cache.get(generation_key)
+    return generation
+
+
 def _get_data_product_uri(request, full_path):
 
     from airavata_django_portal_sdk import models
@@ -231,6 +812,8 @@ def _save_data_product(request, full_path, name=None, content_type=None):
 
 
 def _register_data_product(request, full_path, data_product):
+    if _write_behind_enabled():
+        return _register_data_product_write_behind(request, full_path, data_product)
     product_uri = request.airavata_client.registerDataProduct(
         request.authz_token, data_product
     )
@@ -239,9 +822,37 @@ def _register_data_product(request, full_path, data_product):
         username=request.user.username, file_path=full_path, file_dpu=product_uri
     )
     user_file_instance.save()
+    _invalidate_listing_cache(request.user.username)
     return product_uri
 
 
+def _write_behind_enabled():
+    return getattr(
+        settings, "GATEWAY_DATA_PRODUCT_REGISTRATION_WRITE_BEHIND", False
+    )
+
+
+def _register_data_product_write_behind(request, full_path, data_product):
+    """Record data product with a provisional URI to be registered later."""
+    from airavata_django_portal_sdk import models
+    provisional_uri = "{}{}".format(PROVISIONAL_DATA_PRODUCT_URI_PREFIX, uuid.uuid4())
+    with transaction.atomic():
+        models.UserFiles.objects.create(
+            username=request.user.username,
+            file_path=full_path,
+            file_dpu=provisional_uri,
+        )
+        models.DataProductOutbox.objects.create(
+            provisional_uri=provisional_uri,
+            username=request.user.username,
+            file_path=full_path,
+            data_product=TSerialization.serialize(data_product),
+            next_attempt_time=timezone.now(),
+        )
+    _invalidate_listing_cache(request.user.username)
+    return provisional_uri
+
+
 def _save_copy_of_data_product(request, full_path, data_product):
     """Save copy of a data product with a different path."""
     data_product_copy = _copy_data_product(request, data_product, full_path)
@@ -269,6 +880,19 @@ def _delete_data_product(username, full_path):
     user_file = models.UserFiles.objects.filter(username=username, file_path=full_path)
     if user_file.exists():
         user_file.delete()
+        _invalidate_listing_cache(username)
+
+
+def _delete_data_products(username, full_paths, batch_size=500):
+    """Bulk version of _delete_data_product."""
+    from airavata_django_portal_sdk import models
+    full_paths = list(full_paths)
+    # Batch to stay under the database's limit on query parameters
+    for i in range(0, len(full_paths), batch_size):
+        models.UserFiles.objects.filter(
+            username=username, file_path__in=full_paths[i:i + batch_size]
+        ).delete()
+    _invalidate_listing_cache(username)
 
 
 def _create_data_product(username, full_path, name=None, content_type=None):
@@ -305,6 +929,14 @@ def _determine_content_type(full_path, content_type=None):
     return result
 
 
+def _is_text_file(full_path):
+    content_type = _determine_content_type(full_path)
+    return content_type is not None and (
+        content_type.startswith("text/")
+        or content_type in ("application/json", "application/xml")
+    )
+
+
 def _create_replica_location(full_path, file_name):
     data_replica_location = DataReplicaLocationModel()
     data_replica_location.storageResourceId = settings.GATEWAY_DATA_STORE_RESOURCE_ID
@@ -331,6 +963,371 @@ def _get_replica_filepath(data_product):
     return None
 
 
+_LINE_INDEX_CHUNK_SIZE = 1024 * 1024
+_LINE_INDEX_CACHE_SIZE = 128
+_line_index_cache = collections.OrderedDict()
+_line_index_cache_lock = threading.Lock()
+
+
+class _LineIndex:
+    """Sparse index of line numbers at regularly spaced file offsets.
+
+    checkpoints[i] is the number of newlines before offset i * chunk_size,
+    so finding a line only requires scanning at most one chunk.
+    """
+
+    def __init__(self, size, modified_time, chunk_size=_LINE_INDEX_CHUNK_SIZE):
+        self.size = size
+        self.modified_time = modified_time
+        self.chunk_size = chunk_size
+        self.checkpoints = []
+
+    @classmethod
+    def build(cls, f, size, modified_time, chunk_size=_LINE_INDEX_CHUNK_SIZE):
+        line_index = cls(size, modified_time, chunk_size=chunk_size)
+        line_index._index_from(f, 0)
+        return line_index
+
+    def extend(self, f, size, modified_time):
+        """Return a new index for the file after it has grown to size.
+
+        Assumes bytes were only appended, as for a running job's log, so
+        only the last indexed chunk and the new bytes are read.
+        """
+        line_index = type(self)(size, modified_time, chunk_size=self.chunk_size)
+        line_index.checkpoints = self.checkpoints[:-1]
+        line_index._index_from(f, self.checkpoints[-1])
+        return line_index
+
+    def _index_from(self, f, newlines):
+        """Index from the chunk after the last checkpoint to end of file."""
+        f.seek(len(self.checkpoints) * self.chunk_size)
+        while True:
+            self.checkpoints.append(newlines)
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            newlines += chunk.count(b"\n")
+            if len(chunk) < self.chunk_size:
+                break
+
+    def find_line_offset(self, f, line):
+        """Return offset where line starts, or None if past end of file."""
+        if line == 0:
+            return 0
+        # Last chunk that starts before line's preceding newline
+        i = bisect.bisect_left(self.checkpoints, line) - 1
+        offset = i * self.chunk_size
+        remaining = line - self.checkpoints[i]
+        f.seek(offset)
+        while remaining > 0:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                return None
+            pos = -1
+            count = chunk.count(b"\n")
+            if count < remaining:
+                remaining -= count
+                offset += len(chunk)
+                continue
+            while remaining > 0:
+                pos = chunk.find(b"\n", pos + 1)
+                remaining -= 1
+            offset += pos + 1
+        return offset if offset < self.size else None
+
+
+def _get_line_index(full_path, size, modified_time, f):
+    with _line_index_cache_lock:
+        line_index = _line_index_cache.get(full_path)
+        if line_index is not None:
+            _line_index_cache.move_to_end(full_path)
+    if (
+        line_index is not None
+        and line_index.size == size
+        and line_index.modified_time == modified_time
+    ):
+        return line_index
+    if line_index is not None and size > line_index.size:
+        line_index = line_index.extend(f, size, modified_time)
+    else:
+        line_index = _LineIndex.build(
+            f, size, modified_time, chunk_size=_LINE_INDEX_CHUNK_SIZE
+        )
+    with _line_index_cache_lock:
+        _line_index_cache[full_path] = line_index
+        while len(_line_index_cache) > _LINE_INDEX_CACHE_SIZE:
+            _line_index_cache.popitem(last=False)
+    return line_index
+
+
+def _find_tail_offset(f, size, lines, max_bytes, block_size=65536):
+    """Return offset of the start of the last lines of file f.
+
+    No further back than max_bytes from the end is searched, in which case
+    the returned offset may be in the middle of a line.
+    """
+    end = size
+    # A trailing newline terminates the last line, it doesn't start a new one
+    if size > 0:
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            end = size - 1
+    limit = max(size - max_bytes, 0)
+    remaining = lines
+    offset = end
+    while offset > limit:
+        read_size = min(block_size, offset - limit)
+        offset -= read_size
+        f.seek(offset)
+        block = f.read(read_size)
+        count = block.count(b"\n")
+        if count < remaining:
+            remaining -= count
+            continue
+        pos = len(block)
+        for _ in range(remaining):
+            pos = block.rfind(b"\n", 0, pos)
+        return offset + pos + 1
+    return limit
+
+
+def _find_last_line_end(f, size, max_bytes, block_size=65536):
+    """Return offset just after the last newline of file f.
+
+    Returns 0 if the file has no newline. If there is none in the last
+    max_bytes, returns size so that an overly long line is returned in
+    pieces.
+    """
+    limit = max(size - max_bytes, 0)
+    offset = size
+    while offset > limit:
+        read_size = min(block_size, offset - limit)
+        offset -= read_size
+        f.seek(offset)
+        pos = f.read(read_size).rfind(b"\n")
+        if pos != -1:
+            return offset + pos + 1
+    return 0 if limit == 0 else size
+
+
+def _read_lines_forward(f, offset, lines, max_bytes, block_size=65536):
+    """Read up to lines lines, and at most max_bytes, from offset of file f."""
+    f.seek(offset)
+    blocks = []
+    newlines = 0
+    remaining_bytes = max_bytes
+    while newlines < lines and remaining_bytes > 0:
+        block = f.read(min(block_size, remaining_bytes))
+        if not block:
+            break
+        blocks.append(block)
+        newlines += block.count(b"\n")
+        remaining_bytes -= len(block)
+    return _decode_lines(b"".join(blocks))[:lines]
+
+
+def _decode_lines(data):
+    if not data:
+        return []
+    if data.endswith(b"\n"):
+        data = data[:-1]
+    return [
+        line.rstrip(b"\r").decode("utf-8", errors="replace")
+        for line in data.split(b"\n")
+    ]
+
+
+# Directory in the data store directory that holds the hash-prefix layout's
+# shards. "~" isn't allowed in Django usernames so it can't clash with a flat
+# layout user directory.
+_SHARD_ROOT = "~shards"
+
+
+class _FlatLayout:
+    """All user directories directly in the data store directory."""
+
+    def user_dir(self, directory, username):
+        return os.path.join(directory, username)
+
+    def list_usernames(self, directory):
+        return [
+            entry.name
+            for entry in _scandir(directory)
+            if entry.is_dir() and entry.name != _SHARD_ROOT
+        ]
+
+
+class _HashPrefixLayout:
+    """User directories sharded by a prefix of a hash of the username.
+
+    For example, with the defaults a user directory is at
+    ~shards/ab/cd/username where abcd are the first hex digits of the SHA-1
+    of username.
+    """
+
+    levels = 2
+    width = 2
+
+    def user_dir(self, directory, username):
+        digest = hashlib.sha1(username.encode()).hexdigest()
+        shards = [
+            digest[i * self.width:(i + 1) * self.width] for i in range(self.levels)
+        ]
+        return os.path.join(directory, _SHARD_ROOT, *shards, username)
+
+    def list_usernames(self, directory):
+        shard_dirs = [os.path.join(directory, _SHARD_ROOT)]
+        for _ in range(self.levels):
+            shard_dirs = [
+                entry.path
+                for shard_dir in shard_dirs
+                for entry in _scandir(shard_dir)
+                if entry.is_dir()
+            ]
+        usernames = [
+            entry.name
+            for shard_dir in shard_dirs
+            for entry in _scandir(shard_dir)
+            if entry.is_dir()
+        ]
+        return usernames + self.list_unmigrated_usernames(directory)
+
+    def list_unmigrated_usernames(self, directory):
+        """Return usernames whose directory is still in the flat layout."""
+        return _FlatLayout().list_usernames(directory)
+
+
+_USER_DIR_LAYOUTS = {
+    "flat": _FlatLayout,
+    "hash-prefix": _HashPrefixLayout,
+}
+
+
+def _get_user_dir_layout():
+    layout = getattr(settings, "GATEWAY_DATA_STORE_LAYOUT", "flat")
+    if layout not in _USER_DIR_LAYOUTS:
+        raise ImproperlyConfigured(
+            "Unknown GATEWAY_DATA_STORE_LAYOUT {!r}, must be one of {}".format(
+                layout, ", ".join(_USER_DIR_LAYOUTS)
+            )
+        )
+    return _USER_DIR_LAYOUTS[layout]()
+
+
+def _scandir(directory):
+    try:
+        with os.scandir(directory) as it:
+            return list(it)
+    except FileNotFoundError:
+        return []
+
+
+class _UserFileSystemStorage(FileSystemStorage):
+    """FileSystemStorage that also accepts paths under a legacy location.
+
+    Absolute paths under legacy_location (a user's directory in a previous
+    layout) are mapped to the same relative path under location.
+    """
+
+    def __init__(self, location=None, legacy_location=None, **kwargs):
+        super().__init__(location=location, **kwargs)
+        self.legacy_location = legacy_location
+
+    def path(self, name):
+        if self.legacy_location is not None and os.path.isabs(name):
+            legacy_location = os.path.join(self.legacy_location, "")
+            if name.startswith(legacy_location):
+                name = os.path.join(self.location, name[len(legacy_location):])
+        return super().path(name)
+
+
+_COMPRESSION_CODEC = "gzip"
+_COMPRESSION_FRAME_SIZE = 1024 * 1024
+# Don't bother keeping compressed files that aren't at least 10% smaller
+_COMPRESSION_MIN_RATIO = 0.9
+
+
+def _compression_enabled():
+    return getattr(settings, "GATEWAY_DATA_STORE_COMPRESSION_ENABLED", False)
+
+
+def _is_current_compressed_file(compressed_file):
+    """Return False if the file no longer matches its compression index entry.
+
+    The file may have been removed or replaced outside of this module.
+    """
+    try:
+        size = os.path.getsize(compressed_file.file_path)
+    except FileNotFoundError:
+        return False
+    return size == compressed_file.compressed_size
+
+
+class _FramedGzipReader(io.RawIOBase):
+    """Seekable reader of the original bytes of a compressed user file.
+
+    The file is a concatenation of gzip members (so it is still a valid gzip
+    file) that each hold frame_size bytes of the original. Seeking only
+    requires decompressing the frame holding the new position.
+    """
+
+    def __init__(self, fileobj, original_size, frame_size, frame_offsets):
+        self._fileobj = fileobj
+        self._original_size = original_size
+        self._frame_size = frame_size
+        self._frame_offsets = frame_offsets
+        self._position = 0
+        self._frame_number = None
+        self._frame = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._original_size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        self._position = position
+        return position
+
+    def readinto(self, b):
+        if self._position >= self._original_size:
+            return 0
+        frame_number = self._position // self._frame_size
+        if frame_number != self._frame_number:
+            start, end = self._frame_offsets[frame_number:frame_number + 2]
+            self._fileobj.seek(start)
+            self._frame = gzip.decompress(self._fileobj.read(end - start))
+            self._frame_number = frame_number
+        frame_position = self._position - frame_number * self._frame_size
+        data = self._frame[frame_position:frame_position + len(b)]
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        self._fileobj.close()
+        super().close()
+
+
+# Path, size and modification time of a file found by a directory scan
+_FileEntry = collections.namedtuple("_FileEntry", ["path", "size", "mtime"])
+
+
 class _Datastore:
     """Internal datastore abstraction."""
 
@@ -340,6 +1337,8 @@ class _Datastore:
             self.directory = directory
         else:
             self.directory = settings.GATEWAY_DATA_STORE_DIR
+        self._compressed_files_cache = {}
+        self._user_dir_locations_cache = {}
 
     def exists(self, username, path):
         """Check if file path exists in this data store."""
@@ -364,6 +1363,9 @@ class _Datastore:
     def open(self, username, path):
         """Open path for user if it exists in this data store."""
         if self.exists(username, path):
+            compressed_file = self._get_compressed_file(username, path)
+            if compressed_file is not None:
+                return self._open_compressed_file(compressed_file)
             return self._user_data_storage(username).open(path)
         else:
             raise ObjectDoesNotExist("File path does not exist: {}".format(path))
@@ -372,16 +1374,24 @@ class _Datastore:
         """Save file to username/path in data store."""
         # file.name may be full path, so get just the name of the file
         file_name = name if name is not None else os.path.basename(file.name)
+        _check_storage_quota(username, _get_file_size(file))
         user_data_storage = self._user_data_storage(username)
         file_path = os.path.join(path, user_data_storage.get_valid_name(file_name))
         input_file_name = user_data_storage.save(file_path, file)
         input_file_fullpath = user_data_storage.path(input_file_name)
+        self._update_storage_usage(
+            username, input_file_fullpath, os.path.getsize(input_file_fullpath)
+        )
+        _invalidate_listing_cache(username)
         return input_file_fullpath
 
     def move(
         self, source_username, source_path, target_username, target_dir, file_name
     ):
         source_full_path = self.path(source_username, source_path)
+        size = os.path.getsize(source_full_path)
+        if source_username != target_username:
+            _check_storage_quota(target_username, size)
         user_data_storage = self._user_data_storage(target_username)
         # Make file_name a valid filename
         target_path = os.path.join(
@@ -391,10 +1401,23 @@ class _Datastore:
         # create a uniquely named path
         target_path = user_data_storage.get_available_name(target_path)
         target_full_path = self.path(target_username, target_path)
+        compressed_file = self._get_compressed_file(source_username, source_path)
         file_move_safe(source_full_path, target_full_path)
+        if compressed_file is not None:
+            compressed_file.username = target_username
+            compressed_file.file_path = target_full_path
+            compressed_file.save()
+            self._compressed_files_cache.clear()
+        self._update_storage_usage(source_username, source_full_path, -size)
+        self._update_storage_usage(target_username, target_full_path, size)
+        _invalidate_listing_cache(source_username)
+        _invalidate_listing_cache(target_username)
         return target_full_path
 
     def move_external(self, external_path, target_username, target_dir, file_name):
+        size = os.path.getsize(external_path)
+        # Check quota before moving anything into user's storage
+        _check_storage_quota(target_username, size)
         user_data_storage = self._user_data_storage(target_username)
         # Make file_name a valid filename
         target_path = os.path.join(
@@ -407,6 +1430,8 @@ class _Datastore:
             self.create_user_dir(target_username, target_dir)
         target_full_path = self.path(target_username, target_path)
         file_move_safe(external_path, target_full_path)
+        self._update_storage_usage(target_username, target_full_path, size)
+        _invalidate_listing_cache(target_username)
         return target_full_path
 
     def create_user_dir(self, username, path):
@@ -427,7 +1452,13 @@ class _Datastore:
         """Delete file in this data store."""
         if self.exists(username, path):
             user_data_storage = self._user_data_storage(username)
+            full_path = self.path(username, path)
+            size = os.path.getsize(full_path)
             user_data_storage.delete(path)
+            self._update_storage_usage(username, full_path, -size)
+            # Also removes a stale index entry for the file, if any
+            self._delete_compressed_files(username, [full_path])
+            _invalidate_listing_cache(username)
         else:
             raise ObjectDoesNotExist("File path does not exist: {}".format(path))
 
@@ -435,7 +1466,17 @@ class _Datastore:
         """Delete entire directory in this data store."""
         if self.dir_exists(username, path):
             user_path = self.path(username, path)
+            self._subtract_dir_storage_usage(username, user_path)
             shutil.rmtree(user_path)
+            self._delete_compressed_files(
+                username,
+                [
+                    full_path
+                    for full_path in self._get_compressed_files(username)
+                    if full_path.startswith(os.path.join(user_path, ""))
+                ],
+            )
+            _invalidate_listing_cache(username)
         else:
             raise ObjectDoesNotExist("File path does not exist: {}".format(path))
 
@@ -469,6 +1510,63 @@ class _Datastore:
             self._makedirs(username, experiment_dir)
         return experiment_dir
 
+    def get_experiment_dirs(
+        self, username, project_name, experiment_names, max_workers=8
+    ):
+        """Create and return experiment directories (full paths) in bulk."""
+        user_experiment_data_storage = self._user_data_storage(username)
+        proj_dir_name = user_experiment_data_storage.get_valid_name(project_name)
+        proj_dir = user_experiment_data_storage.path(proj_dir_name)
+        try:
+            taken_names = set(os.listdir(proj_dir))
+        except FileNotFoundError:
+            taken_names = set()
+            # AIRAVATA-3245 Make project directory with correct permissions
+            try:
+                self._makedirs(username, proj_dir_name)
+            except FileExistsError:
+                pass
+        taken_names_lock = threading.Lock()
+
+        def reserve_name(experiment_name):
+            valid_name = user_experiment_data_storage.get_valid_name(experiment_name)
+            with taken_names_lock:
+                name = valid_name
+                # Same naming scheme as Storage.get_available_name
+                dir_root, dir_ext = os.path.splitext(valid_name)
+                while name in taken_names:
+                    name = "{}_{}{}".format(dir_root, get_random_string(7), dir_ext)
+                taken_names.add(name)
+            return name
+
+        mode = user_experiment_data_storage.directory_permissions_mode
+
+        def create_dir(args):
+            experiment_name, name = args
+            while True:
+                experiment_dir = os.path.join(proj_dir, name)
+                try:
+                    if mode is not None:
+                        os.mkdir(experiment_dir, mode=mode)
+                    else:
+                        os.mkdir(experiment_dir)
+                    break
+                except FileExistsError:
+                    # Created by someone else since the project dir was listed
+                    name = reserve_name(experiment_name)
+            if mode is not None:
+                # os.mkdir mode isn't always respected so need to chmod to be sure
+                os.chmod(experiment_dir, mode=mode)
+            return experiment_dir
+
+        names = [reserve_name(experiment_name) for experiment_name in experiment_names]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            experiment_dirs = list(
+                executor.map(create_dir, zip(experiment_names, names))
+            )
+        _invalidate_listing_cache(username)
+        return experiment_dirs
+
     def _makedirs(self, username, dir_path):
         user_experiment_data_storage = self._user_data_storage(username)
         full_path = user_experiment_data_storage.path(dir_path)
@@ -479,6 +1577,306 @@ class _Datastore:
         os.chmod(
             full_path, mode=user_experiment_data_storage.directory_permissions_mode
         )
+        _invalidate_listing_cache(username)
+
+    def list_usernames(self):
+        """Return the usernames that have a directory in this data store."""
+        return _get_user_dir_layout().list_usernames(self.directory)
+
+    def migrate_user_dir(self, username, layout, batch_size=500):
+        """Move user's directory from the flat layout to layout.
+
+        Returns False if there was nothing to migrate.
+        """
+        from airavata_django_portal_sdk import models
+        old_dir = _FlatLayout().user_dir(self.directory, username)
+        new_dir = layout.user_dir(self.directory, username)
+        if not os.path.isdir(old_dir) or os.path.exists(new_dir):
+            return False
+        old_prefix = os.path.join(old_dir, "")
+        with transaction.atomic():
+            for model in (
+                models.UserFiles,
+                models.CompressedUserFile,
+                models.DataProductOutbox,
+            ):
+                batch = []
+                for instance in model.objects.filter(username=username).iterator():
+                    if instance.file_path.startswith(old_prefix):
+                        instance.file_path = os.path.join(
+                            new_dir, instance.file_path[len(old_prefix):]
+                        )
+                        batch.append(instance)
+                    if len(batch) >= batch_size:
+                        model.objects.bulk_update(batch, ["file_path"])
+                        batch = []
+                if batch:
+                    model.objects.bulk_update(batch, ["file_path"])
+            os.makedirs(os.path.dirname(new_dir), exist_ok=True)
+            os.rename(old_dir, new_dir)
+        self._compressed_files_cache.pop(username, None)
+        self._user_dir_locations_cache.pop(username, None)
+        _invalidate_listing_cache(username)
+        return True
+
+    def scan_tmp_input_files(self, username):
+        """Return a _FileEntry for each file in user's input staging area."""
+        tmp_dir = self.path(username, TMP_INPUT_FILE_UPLOAD_DIR)
+        entries = []
+        try:
+            with os.scandir(tmp_dir) as it:
+                for entry in it:
+                    try:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        # Removed while scanning
+                        continue
+                    entries.append(
+                        _FileEntry(entry.path, stat.st_size, stat.st_mtime)
+                    )
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return entries
+
+    def delete_files(self, username, full_paths, max_workers=8):
+        """Delete files given by full path, ignoring ones already gone."""
+        user_root = self.path(username, "")
+        for full_path in full_paths:
+            if os.path.commonpath([user_root, full_path]) != user_root:
+                raise SuspiciousFileOperation(
+                    "Path {} is not in storage of user {}".format(full_path, username)
+                )
+
+        def remove(full_path):
+            try:
+                size = os.path.getsize(full_path)
+                os.remove(full_path)
+                return full_path, size
+            except FileNotFoundError:
+                return full_path, 0
+
+        # Only the removal is done in parallel, database updates need to be
+        # done from the calling thread
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            removed = list(executor.map(remove, full_paths))
+        usage_deltas = collections.Counter()
+        for full_path, size in removed:
+            usage_deltas[self._get_top_level_dir(username, full_path)] -= size
+        for directory, delta in usage_deltas.items():
+            _update_storage_usage(username, directory, delta)
+        self._delete_compressed_files(username, full_paths)
+        _invalidate_listing_cache(username)
+
+    def find_cold_text_files(self, username, min_age_seconds, min_size):
+        """Return full paths of uncompressed text files not recently modified."""
+        user_root = self.path(username, "")
+        compressed_files = self._get_compressed_files(username)
+        # Drop index entries for files that were removed or replaced outside
+        # of this module so that replaced files can be compressed again
+        stale_paths = [
+            full_path
+            for full_path, compressed_file in compressed_files.items()
+            if not _is_current_compressed_file(compressed_file)
+        ]
+        if stale_paths:
+            logger.info(
+                "Removing {} stale compression index entries for {}".format(
+                    len(stale_paths), username
+                )
+            )
+            self._delete_compressed_files(username, stale_paths)
+            compressed_files = self._get_compressed_files(username)
+        now = time.time()
+        candidates = []
+        for dirpath, dirnames, filenames in os.walk(user_root):
+            if dirpath == user_root and TMP_INPUT_FILE_UPLOAD_DIR in dirnames:
+                dirnames.remove(TMP_INPUT_FILE_UPLOAD_DIR)
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                if full_path in compressed_files:
+                    continue
+                try:
+                    stat = os.stat(full_path, follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if (
+                    not os.path.islink(full_path)
+                    and stat.st_size >= min_size
+                    and now - stat.st_mtime >= min_age_seconds
+                    and _is_text_file(full_path)
+                ):
+                    candidates.append(full_path)
+        return candidates
+
+    def compress_file(self, username, full_path):
+        """Compress file in place and return an unsaved CompressedUserFile.
+
+        Returns None if the file wasn't compressed. The returned
+        CompressedUserFile must be passed to add_compressed_file. Safe to
+        call from multiple threads for different files.
+        """
+        from airavata_django_portal_sdk import models
+        stat = os.stat(full_path)
+        tmp_path = os.path.join(
+            os.path.dirname(full_path),
+            ".{}.{}.compressing".format(
+                os.path.basename(full_path), get_random_string(7)
+            ),
+        )
+        frame_offsets = [0]
+        try:
+            with open(full_path, "rb") as source, open(tmp_path, "wb") as target:
+                while True:
+                    frame = source.read(_COMPRESSION_FRAME_SIZE)
+                    if not frame:
+                        break
+                    # mtime=0 makes output deterministic
+                    target.write(gzip.compress(frame, mtime=0))
+                    frame_offsets.append(target.tell())
+            compressed_size = frame_offsets[-1]
+            new_stat = os.stat(full_path)
+            if (
+                compressed_size > stat.st_size * _COMPRESSION_MIN_RATIO
+                or (new_stat.st_size, new_stat.st_mtime_ns)
+                != (stat.st_size, stat.st_mtime_ns)
+            ):
+                # Doesn't compress well or was modified while compressing
+                os.remove(tmp_path)
+                return None
+            shutil.copymode(full_path, tmp_path)
+            os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(tmp_path, full_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return models.CompressedUserFile(
+            username=username,
+            file_path=full_path,
+            codec=_COMPRESSION_CODEC,
+            original_size=stat.st_size,
+            compressed_size=compressed_size,
+            frame_size=_COMPRESSION_FRAME_SIZE,
+            frame_offsets=json.dumps(frame_offsets),
+        )
+
+    def add_compressed_file(self, compressed_file):
+        compressed_file.save()
+        self._update_storage_usage(
+            compressed_file.username,
+            compressed_file.file_path,
+            compressed_file.compressed_size - compressed_file.original_size,
+        )
+        self._compressed_files_cache.pop(compressed_file.username, None)
+        _invalidate_listing_cache(compressed_file.username)
+
+    def get_storage_usage_by_dir(self, username):
+        """Return dict of top-level directory to bytes used, walking the tree.
+
+        Files directly in the user's directory are counted under "".
+        """
+        user_root = self.path(username, "")
+        usage = collections.Counter()
+        for entry in _scandir(user_root):
+            if entry.is_dir(follow_symlinks=False):
+                usage[entry.name] += self._get_dir_size(entry.path)
+            elif os.path.exists(entry.path):
+                usage[""] += os.path.getsize(entry.path)
+        return dict(usage)
+
+    def _get_top_level_dir(self, username, full_path, is_dir=False):
+        rel_path = os.path.relpath(full_path, self.path(username, ""))
+        parts = rel_path.split(os.sep, 1)
+        return parts[0] if is_dir or len(parts) > 1 else ""
+
+    def _update_storage_usage(self, username, full_path, delta, is_dir=False):
+        _update_storage_usage(
+            username, self._get_top_level_dir(username, full_path, is_dir), delta
+        )
+
+    def _subtract_dir_storage_usage(self, username, dir_path):
+        if os.path.relpath(dir_path, self.path(username, "")) == ".":
+            for directory, size in self.get_storage_usage_by_dir(username).items():
+                _update_storage_usage(username, directory, -size)
+        else:
+            self._update_storage_usage(
+                username, dir_path, -self._get_dir_size(dir_path), is_dir=True
+            )
+
+    def _get_compressed_files(self, username):
+        """Return dict of full path to CompressedUserFile for the user.
+
+        Loaded with a single query, without the frame offsets, and cached for
+        the lifetime of this _Datastore so that listing a directory doesn't
+        query per file.
+        """
+        if not _compression_enabled():
+            return {}
+        if username not in self._compressed_files_cache:
+            from airavata_django_portal_sdk import models
+            self._compressed_files_cache[username] = {
+                compressed_file.file_path: compressed_file
+                for compressed_file in models.CompressedUserFile.objects.filter(
+                    username=username
+                ).defer("frame_offsets")
+            }
+        return self._compressed_files_cache[username]
+
+    def _get_compressed_file(self, username, path):
+        """Return the CompressedUserFile for path or None if not compressed.
+
+        Uses the user's cached index if it has already been loaded, otherwise
+        looks up just this file.
+        """
+        if not _compression_enabled():
+            return None
+        full_path = self.path(username, path)
+        if username in self._compressed_files_cache:
+            compressed_file = self._compressed_files_cache[username].get(full_path)
+        else:
+            from airavata_django_portal_sdk import models
+            compressed_file = models.CompressedUserFile.objects.filter(
+                username=username, file_path=full_path
+            ).first()
+        if compressed_file is None:
+            return None
+        if not _is_current_compressed_file(compressed_file):
+            # Stale entries are removed by compress_cold_files
+            logger.warning(
+                "Ignoring stale compression index entry for {}".format(full_path)
+            )
+            return None
+        return compressed_file
+
+    def _delete_compressed_files(self, username, full_paths, batch_size=500):
+        if not _compression_enabled():
+            return
+        from airavata_django_portal_sdk import models
+        full_paths = list(full_paths)
+        for i in range(0, len(full_paths), batch_size):
+            models.CompressedUserFile.objects.filter(
+                username=username, file_path__in=full_paths[i:i + batch_size]
+            ).delete()
+        self._compressed_files_cache.pop(username, None)
+
+    def _open_compressed_file(self, compressed_file):
+        if compressed_file.codec != _COMPRESSION_CODEC:
+            raise Exception(
+                "Unsupported compression codec {}".format(compressed_file.codec)
+            )
+        reader = _FramedGzipReader(
+            open(compressed_file.file_path, "rb"),
+            compressed_file.original_size,
+            compressed_file.frame_size,
+            json.loads(compressed_file.frame_offsets),
+        )
+        # Don't use the full path as the name: FileResponse would then use
+        # the compressed size on disk as the Content-Length
+        return File(
+            io.BufferedReader(reader), name=os.path.basename(compressed_file.file_path)
+        )
 
     def list_user_dir(self, username, file_path):
         logger.debug("file_path={}".format(file_path))
@@ -489,11 +1887,30 @@ class _Datastore:
         user_data_storage = self._user_data_storage(username)
         return user_data_storage.get_created_time(file_path)
 
+    def get_modified_time(self, username, file_path):
+        user_data_storage = self._user_data_storage(username)
+        return user_data_storage.get_modified_time(file_path)
+
     def size(self, username, file_path):
         user_data_storage = self._user_data_storage(username)
         full_path = self.path(username, file_path)
         if os.path.isdir(full_path):
-            return self._get_dir_size(full_path)
+            size = self._get_dir_size(full_path)
+            # Report the original size of compressed files in the directory
+            for compressed_path, compressed_file in self._get_compressed_files(
+                username
+            ).items():
+                if compressed_path.startswith(
+                    os.path.join(full_path, "")
+                ) and _is_current_compressed_file(compressed_file):
+                    size += (
+                        compressed_file.original_size
+                        - compressed_file.compressed_size
+                    )
+            return size
+        compressed_file = self._get_compressed_file(username, file_path)
+        if compressed_file is not None:
+            return compressed_file.original_size
         else:
             return user_data_storage.size(file_path)
 
@@ -506,7 +1923,21 @@ class _Datastore:
         return os.path.relpath(full_path, self.path(username, ""))
 
     def _user_data_storage(self, username):
-        return FileSystemStorage(location=os.path.join(self.directory, username))
+        layout = _get_user_dir_layout()
+        location = layout.user_dir(self.directory, username)
+        if isinstance(layout, _FlatLayout):
+            return _UserFileSystemStorage(location=location)
+        if username not in self._user_dir_locations_cache:
+            legacy_location = _FlatLayout().user_dir(self.directory, username)
+            if not os.path.isdir(location) and os.path.isdir(legacy_location):
+                # User hasn't been migrated to the new layout yet
+                self._user_dir_locations_cache[username] = (legacy_location, None)
+            else:
+                self._user_dir_locations_cache[username] = (location, legacy_location)
+        location, legacy_location = self._user_dir_locations_cache[username]
+        return _UserFileSystemStorage(
+            location=location, legacy_location=legacy_location
+        )
 
     # from https://stackoverflow.com/a/1392549
     def _get_dir_size(self, start_path="."):
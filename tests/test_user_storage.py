@@ -1,12 +1,16 @@
+import hashlib
 import io
 import os
 import tempfile
+import time
 import uuid
-from unittest.mock import MagicMock
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
 from urllib.parse import urlparse
 
 from django.contrib.auth.models import User
 from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
 
 from airavata.model.data.replica.ttypes import (
     DataProductModel,
@@ -14,7 +18,8 @@ from airavata.model.data.replica.ttypes import (
     DataReplicaLocationModel,
     ReplicaLocationCategory
 )
-from airavata_django_portal_sdk import user_storage
+from airavata_django_portal_sdk import models, user_storage
+from airavata_django_portal_sdk.testing import LocalAiravataClient
 
 GATEWAY_ID = 'test-gateway'
 
@@ -35,6 +40,20 @@ class BaseTestCase(TestCase):
         self.request.authz_token = "dummy"
 
 
+class TmpDataStoreTestCase(BaseTestCase):
+    "BaseTestCase with GATEWAY_DATA_STORE_DIR set to a temporary directory"
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.settings_override = self.settings(
+            GATEWAY_DATA_STORE_DIR=self.tmpdir.name,
+            GATEWAY_DATA_STORE_HOSTNAME="gateway.com")
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+
 class SaveTests(BaseTestCase):
 
     def test_save_with_defaults(self):
@@ -180,3 +199,675 @@ class CopyInputFileUploadTests(BaseTestCase):
                 os.path.dirname(replica_copy_filepath),
                 os.path.join(tmpdirname, self.user.username, "tmp"),
                 msg="Verify input file copied to user's tmp dir")
+
+
+class CleanupTmpInputFilesTests(TestCase):
+
+    def _create_tmp_file(self, tmpdirname, username, name, size, age):
+        path = os.path.join(tmpdirname, username, "tmp", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b"x" * size)
+        mtime = time.time() - age.total_seconds()
+        os.utime(path, (mtime, mtime))
+        models.UserFiles.objects.create(
+            username=username, file_path=path,
+            file_dpu=f"airavata-dp://{uuid.uuid4()}")
+        return path
+
+    def test_removes_files_older_than_max_age(self):
+        with tempfile.TemporaryDirectory() as tmpdirname, \
+                self.settings(GATEWAY_DATA_STORE_DIR=tmpdirname):
+            old = self._create_tmp_file(
+                tmpdirname, "user1", "old.txt", 10, timedelta(days=8))
+            new = self._create_tmp_file(
+                tmpdirname, "user2", "new.txt", 10, timedelta(hours=1))
+
+            removed = user_storage.cleanup_tmp_input_files(
+                max_age=timedelta(days=7))
+
+            self.assertDictEqual({"user1": [old]}, removed)
+            self.assertFalse(os.path.exists(old))
+            self.assertTrue(os.path.exists(new))
+            self.assertFalse(models.UserFiles.objects.filter(
+                file_path=old).exists())
+            self.assertTrue(models.UserFiles.objects.filter(
+                file_path=new).exists())
+
+    def test_removes_oldest_files_over_max_size(self):
+        with tempfile.TemporaryDirectory() as tmpdirname, \
+                self.settings(GATEWAY_DATA_STORE_DIR=tmpdirname):
+            oldest = self._create_tmp_file(
+                tmpdirname, "user1", "a.txt", 10, timedelta(hours=3))
+            older = self._create_tmp_file(
+                tmpdirname, "user1", "b.txt", 10, timedelta(hours=2))
+            newest = self._create_tmp_file(
+                tmpdirname, "user1", "c.txt", 10, timedelta(hours=1))
+
+            removed = user_storage.cleanup_tmp_input_files(max_size=15)
+
+            self.assertDictEqual({"user1": [oldest, older]}, removed)
+            self.assertTrue(os.path.exists(newest))
+
+    def test_skips_referenced_files(self):
+        with tempfile.TemporaryDirectory() as tmpdirname, \
+                self.settings(GATEWAY_DATA_STORE_DIR=tmpdirname):
+            in_use = self._create_tmp_file(
+                tmpdirname, "user1", "in_use.txt", 10, timedelta(days=8))
+            unused = self._create_tmp_file(
+                tmpdirname, "user1", "unused.txt", 10, timedelta(days=8))
+            is_referenced = MagicMock(return_value=[in_use])
+
+            removed = user_storage.cleanup_tmp_input_files(
+                max_age=timedelta(days=7), is_referenced=is_referenced)
+
+            self.assertDictEqual({"user1": [unused]}, removed)
+            self.assertTrue(os.path.exists(in_use))
+            username, full_paths = is_referenced.call_args[0]
+            self.assertEqual("user1", username)
+            self.assertCountEqual([in_use, unused], full_paths)
+
+    def test_dry_run(self):
+        with tempfile.TemporaryDirectory() as tmpdirname, \
+                self.settings(GATEWAY_DATA_STORE_DIR=tmpdirname):
+            old = self._create_tmp_file(
+                tmpdirname, "user1", "old.txt", 10, timedelta(days=8))
+
+            removed = user_storage.cleanup_tmp_input_files(
+                max_age=timedelta(days=7), dry_run=True)
+
+            self.assertDictEqual({"user1": [old]}, removed)
+            self.assertTrue(os.path.exists(old))
+            self.assertTrue(models.UserFiles.objects.filter(
+                file_path=old).exists())
+
+
+class PreviewTests(TmpDataStoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(
+            self.tmpdir.name, self.user.username, "output.log")
+        os.makedirs(os.path.dirname(self.path))
+        self.data_product = DataProductModel(
+            ownerName=self.user.username,
+            replicaLocations=[DataReplicaLocationModel(
+                filePath=f"file://gateway.com:{self.path}",
+                replicaLocationCategory=(
+                    ReplicaLocationCategory.GATEWAY_DATA_STORE))])
+
+    def _write(self, content, mode='w'):
+        with open(self.path, mode) as f:
+            f.write(content)
+
+    def test_preview_head(self):
+        self._write("".join(f"line {i}\n" for i in range(100)))
+        self.assertEqual(
+            ["line 0", "line 1", "line 2"],
+            user_storage.preview_head(self.request, self.data_product, 3))
+
+    def test_preview_tail(self):
+        self._write("".join(f"line {i}\n" for i in range(100)))
+        self.assertEqual(
+            ["line 97", "line 98", "line 99"],
+            user_storage.preview_tail(self.request, self.data_product, 3))
+
+    def test_preview_tail_without_trailing_newline(self):
+        self._write("a\nb\r\nc")
+        self.assertEqual(
+            ["b", "c"],
+            user_storage.preview_tail(self.request, self.data_product, 2))
+        self.assertEqual(
+            ["a", "b", "c"],
+            user_storage.preview_tail(self.request, self.data_product, 10))
+
+    @patch.object(user_storage, "_LINE_INDEX_CHUNK_SIZE", 16)
+    def test_preview_lines(self):
+        self._write("".join(f"line {i}\n" for i in range(100)))
+        self.assertEqual(
+            ["line 42", "line 43", "line 44"],
+            user_storage.preview_lines(
+                self.request, self.data_product, 42, 45))
+        self.assertEqual(
+            ["line 0"],
+            user_storage.preview_lines(self.request, self.data_product, 0, 1))
+        self.assertEqual(
+            ["line 99"],
+            user_storage.preview_lines(
+                self.request, self.data_product, 99, 200))
+        self.assertEqual(
+            [],
+            user_storage.preview_lines(
+                self.request, self.data_product, 100, 200))
+
+    @patch.object(user_storage, "_LINE_INDEX_CHUNK_SIZE", 16)
+    def test_preview_lines_index_invalidated_when_file_shrinks(self):
+        self._write("".join(f"line {i}\n" for i in range(100)))
+        user_storage.preview_lines(self.request, self.data_product, 42, 45)
+        self._write("".join(f"new {i}\n" for i in range(100)))
+        self.assertEqual(
+            ["new 42"],
+            user_storage.preview_lines(
+                self.request, self.data_product, 42, 43))
+
+    @patch.object(user_storage, "_LINE_INDEX_CHUNK_SIZE", 16)
+    def test_preview_lines_index_extended_when_file_grows(self):
+        self._write("".join(f"line {i}\n" for i in range(100)))
+        user_storage.preview_lines(self.request, self.data_product, 42, 45)
+        with patch.object(user_storage._LineIndex, "build") as build:
+            for i in range(100, 103):
+                self._write(f"line {i}\n", mode='a')
+                self.assertEqual(
+                    [f"line {i}"],
+                    user_storage.preview_lines(
+                        self.request, self.data_product, i, i + 1))
+            build.assert_not_called()
+
+    def test_preview_reads_at_most_max_bytes(self):
+        self._write("x" * 1000 + "\n" + "y" * 1000)
+        self.assertEqual(
+            ["x" * 100],
+            user_storage.preview_head(
+                self.request, self.data_product, 2, max_bytes=100))
+        self.assertEqual(
+            ["y" * 100],
+            user_storage.preview_tail(
+                self.request, self.data_product, 2, max_bytes=100))
+        self.assertEqual(
+            ["y" * 100],
+            user_storage.preview_lines(
+                self.request, self.data_product, 1, 2, max_bytes=100))
+        lines, cursor = user_storage.preview_follow(
+            self.request, self.data_product, max_bytes=100)
+        self.assertEqual(["y" * 100], lines)
+        self.assertEqual(2001, cursor)
+
+    def test_preview_follow(self):
+        self._write("a\nb\n")
+        lines, cursor = user_storage.preview_follow(
+            self.request, self.data_product, lines=1)
+        self.assertEqual(["b"], lines)
+        self._write("c\nd", mode='a')
+        lines, cursor = user_storage.preview_follow(
+            self.request, self.data_product, cursor=cursor)
+        self.assertEqual(["c"], lines)
+        self._write("\n", mode='a')
+        lines, cursor = user_storage.preview_follow(
+            self.request, self.data_product, cursor=cursor)
+        self.assertEqual(["d"], lines)
+        lines, cursor = user_storage.preview_follow(
+            self.request, self.data_product, cursor=cursor)
+        self.assertEqual([], lines)
+
+    def test_preview_follow_starts_after_partial_line(self):
+        self._write("a\nb\nc")
+        lines, cursor = user_storage.preview_follow(
+            self.request, self.data_product)
+        self.assertEqual(["a", "b"], lines)
+        self._write("d\n", mode='a')
+        lines, cursor = user_storage.preview_follow(
+            self.request, self.data_product, cursor=cursor)
+        self.assertEqual(["cd"], lines)
+
+
+@override_settings(
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'listing': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'listing',
+        },
+    },
+    GATEWAY_DATA_STORE_LISTING_CACHE='listing',
+    FILE_UPLOAD_DIRECTORY_PERMISSIONS=0o755)
+class ListdirCacheTests(TmpDataStoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        user_storage._get_listing_cache().clear()
+        os.makedirs(os.path.join(self.tmpdir.name, self.user.username))
+
+    def _save(self, name):
+        file = io.StringIO("Foo file")
+        file.name = name
+        # Each registered data product needs a unique URI
+        self.request.airavata_client.registerDataProduct.return_value = \
+            f"airavata-dp://{uuid.uuid4()}"
+        return user_storage.save(self.request, "", file)
+
+    def test_repeated_listdir_is_cached(self):
+        self._save("foo.txt")
+        first = user_storage.listdir(self.request, "")
+        with patch.object(user_storage._Datastore, "list_user_dir") as m:
+            second = user_storage.listdir(self.request, "")
+            m.assert_not_called()
+        self.assertEqual(first, second)
+
+    def test_listdir_cache_invalidated_by_save(self):
+        self._save("foo.txt")
+        user_storage.listdir(self.request, "")
+        self._save("bar.txt")
+        directories, files = user_storage.listdir(self.request, "")
+        self.assertCountEqual(
+            ["foo.txt", "bar.txt"], [f["name"] for f in files])
+
+    def test_listdir_cache_reports_sizes_changed_outside_of_sdk(self):
+        self._save("foo.txt")
+        user_storage.create_user_dir(self.request, "exp")
+        out_log = os.path.join(
+            self.tmpdir.name, self.user.username, "exp", "out.log")
+        with open(out_log, 'wb') as f:
+            f.write(b"x")
+        user_storage.listdir(self.request, "")
+        with open(out_log, 'ab') as f:
+            f.write(b"x" * 1000)
+        with open(os.path.join(
+                self.tmpdir.name, self.user.username, "foo.txt"), 'a') as f:
+            f.write("more")
+
+        directories, files = user_storage.listdir(self.request, "")
+
+        self.assertEqual(1001, directories[0]["size"])
+        self.assertEqual(len("Foo filemore"), files[0]["size"])
+
+    def test_listdir_cache_invalidated_when_generation_evicted(self):
+        self._save("foo.txt")
+        user_storage.listdir(self.request, "")
+        generation_key, _ = user_storage._get_listing_cache_keys(
+            self.user.username)
+        user_storage._get_listing_cache().delete(generation_key)
+        with patch.object(user_storage._Datastore, "list_user_dir",
+                          return_value=([], [])) as m:
+            user_storage.listdir(self.request, "")
+            m.assert_called_once()
+
+    def test_listdir_cache_invalidated_by_delete_dir(self):
+        user_storage.create_user_dir(self.request, "subdir")
+        directories, files = user_storage.listdir(self.request, "")
+        self.assertEqual(["subdir"], [d["name"] for d in directories])
+        user_storage.delete_dir(self.request, "subdir")
+        directories, files = user_storage.listdir(self.request, "")
+        self.assertEqual([], directories)
+
+
+@override_settings(FILE_UPLOAD_DIRECTORY_PERMISSIONS=0o750)
+class GetExperimentDirsTests(BaseTestCase):
+
+    def test_get_experiment_dirs(self):
+        with tempfile.TemporaryDirectory() as tmpdirname, \
+                self.settings(GATEWAY_DATA_STORE_DIR=tmpdirname):
+            project_dir = os.path.join(
+                tmpdirname, self.user.username, "My_Project")
+            os.makedirs(os.path.join(project_dir, "exp_1"))
+
+            experiment_dirs = user_storage.get_experiment_dirs(
+                self.request, "My Project", ["exp 1", "exp 2", "exp 2"])
+
+            self.assertEqual(3, len(experiment_dirs))
+            self.assertEqual(3, len(set(experiment_dirs)))
+            self.assertNotEqual(
+                os.path.join(project_dir, "exp_1"), experiment_dirs[0])
+            self.assertTrue(
+                os.path.basename(experiment_dirs[0]).startswith("exp_1_"))
+            self.assertEqual(
+                os.path.join(project_dir, "exp_2"), experiment_dirs[1])
+            self.assertTrue(
+                os.path.basename(experiment_dirs[2]).startswith("exp_2_"))
+            for experiment_dir in experiment_dirs:
+                self.assertEqual(project_dir, os.path.dirname(experiment_dir))
+                self.assertTrue(os.path.isdir(experiment_dir))
+                self.assertEqual(
+                    0o750, os.stat(experiment_dir).st_mode & 0o777)
+
+    def test_get_experiment_dirs_creates_project_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdirname, \
+                self.settings(GATEWAY_DATA_STORE_DIR=tmpdirname):
+            experiment_dirs = user_storage.get_experiment_dirs(
+                self.request, "proj", ["exp"])
+
+            self.assertEqual(
+                [os.path.join(tmpdirname, self.user.username, "proj", "exp")],
+                experiment_dirs)
+            self.assertTrue(os.path.isdir(experiment_dirs[0]))
+
+
+@override_settings(GATEWAY_DATA_STORE_COMPRESSION_ENABLED=True)
+class CompressionTests(TmpDataStoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(
+            self.tmpdir.name, self.user.username, "outputs", "output.log")
+        os.makedirs(os.path.dirname(self.path))
+        self.content = "".join(f"line {i}\n" for i in range(100000)).encode()
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.mtime = time.time() - timedelta(days=30).total_seconds()
+        os.utime(self.path, (self.mtime, self.mtime))
+        self.data_product = DataProductModel(
+            ownerName=self.user.username,
+            replicaLocations=[DataReplicaLocationModel(
+                filePath=f"file://gateway.com:{self.path}",
+                replicaLocationCategory=(
+                    ReplicaLocationCategory.GATEWAY_DATA_STORE))])
+
+    def test_compress_cold_files(self):
+        recent = os.path.join(os.path.dirname(self.path), "recent.log")
+        with open(recent, 'wb') as f:
+            f.write(self.content)
+
+        compressed = user_storage.compress_cold_files(min_size=1024)
+
+        self.assertDictEqual({self.user.username: [self.path]}, compressed)
+        self.assertLess(os.path.getsize(self.path), len(self.content))
+        self.assertEqual(len(self.content), os.path.getsize(recent))
+        self.assertAlmostEqual(self.mtime, os.path.getmtime(self.path))
+
+    @patch.object(user_storage, "_COMPRESSION_FRAME_SIZE", 4096)
+    def test_compressed_file_reads_as_original(self):
+        user_storage.compress_cold_files(min_size=1024)
+
+        with user_storage.open_file(self.request, self.data_product) as f:
+            self.assertEqual(self.content, f.read())
+            f.seek(len(self.content) - 10)
+            self.assertEqual(self.content[-10:], f.read())
+        self.assertEqual(
+            ["line 99999"],
+            user_storage.preview_tail(self.request, self.data_product, 1))
+        self.assertEqual(
+            ["line 50000"],
+            user_storage.preview_lines(
+                self.request, self.data_product, 50000, 50001))
+        directories, files = user_storage.listdir(self.request, "")
+        self.assertEqual(len(self.content), directories[0]["size"])
+        directories, files = user_storage.listdir(self.request, "outputs")
+        self.assertEqual(len(self.content), files[0]["size"])
+
+    def test_compressed_file_replaced_outside_of_sdk(self):
+        user_storage.compress_cold_files(min_size=1024)
+        with open(self.path, 'wb') as f:
+            f.write(b"new content\n")
+
+        with user_storage.open_file(self.request, self.data_product) as f:
+            self.assertEqual(b"new content\n", f.read())
+        directories, files = user_storage.listdir(self.request, "outputs")
+        self.assertEqual(len(b"new content\n"), files[0]["size"])
+        # Reading doesn't modify the index, compress_cold_files cleans it up
+        self.assertTrue(models.CompressedUserFile.objects.exists())
+        user_storage.compress_cold_files(min_size=1024)
+        self.assertFalse(models.CompressedUserFile.objects.exists())
+
+    def test_delete_compressed_file(self):
+        user_storage.compress_cold_files(min_size=1024)
+
+        user_storage.delete(self.request, self.data_product)
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(models.CompressedUserFile.objects.exists())
+
+
+@override_settings(GATEWAY_DATA_STORE_LAYOUT="hash-prefix")
+class HashPrefixLayoutTests(TmpDataStoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        digest = hashlib.sha1(self.user.username.encode()).hexdigest()
+        self.user_dir = os.path.join(
+            self.tmpdir.name, "~shards", digest[:2], digest[2:4],
+            self.user.username)
+
+    def test_save_in_sharded_user_dir(self):
+        file = io.StringIO("Foo file")
+        file.name = "foo.txt"
+        data_product = user_storage.save(self.request, "", file)
+
+        self.assertEqual(
+            f"file://gateway.com:{self.user_dir}/foo.txt",
+            data_product.replicaLocations[0].filePath)
+        self.assertTrue(os.path.isfile(os.path.join(self.user_dir, "foo.txt")))
+
+    def test_user_dir_location_resolved_once(self):
+        os.makedirs(self.user_dir)
+        datastore = user_storage._Datastore()
+        with patch("os.path.isdir", wraps=os.path.isdir) as isdir:
+            datastore.path(self.user.username, "foo.txt")
+            datastore.path(self.user.username, "bar.txt")
+
+        # The legacy location isn't checked once the new one exists
+        isdir.assert_called_once_with(self.user_dir)
+
+    def test_unmigrated_user_named_like_a_shard(self):
+        # A flat layout user whose name looks like a hash prefix
+        shard_like_dir = os.path.join(self.tmpdir.name, "ab")
+        os.makedirs(shard_like_dir)
+        with open(os.path.join(shard_like_dir, "foo.txt"), 'w') as f:
+            f.write("Foo file")
+        # Another user whose SHA-1 starts with "ab"
+        other_user = User.objects.create_user('user178')
+        self.assertTrue(hashlib.sha1(b'user178').hexdigest().startswith("ab"))
+        self.request.user = other_user
+        file = io.StringIO("Secret")
+        file.name = "secret.txt"
+        user_storage.save(self.request, "", file)
+        self.assertEqual(["foo.txt"], os.listdir(shard_like_dir))
+
+        self.assertCountEqual(
+            ["ab", "user178"], user_storage._Datastore().list_usernames())
+        self.assertEqual(["ab"], user_storage.migrate_user_layout())
+        self.assertFalse(os.path.exists(shard_like_dir))
+        self.assertCountEqual(
+            ["ab", "user178"], user_storage._Datastore().list_usernames())
+
+    def test_migrate_user_layout(self):
+        legacy_user_dir = os.path.join(self.tmpdir.name, self.user.username)
+        legacy_path = os.path.join(legacy_user_dir, "data", "foo.txt")
+        os.makedirs(os.path.dirname(legacy_path))
+        with open(legacy_path, 'w') as f:
+            f.write("Foo file")
+        models.UserFiles.objects.create(
+            username=self.user.username, file_path=legacy_path,
+            file_dpu=self.product_uri)
+        models.DataProductOutbox.objects.create(
+            provisional_uri=(user_storage.PROVISIONAL_DATA_PRODUCT_URI_PREFIX
+                             + str(uuid.uuid4())),
+            username=self.user.username, file_path=legacy_path,
+            data_product=b"", next_attempt_time=timezone.now())
+        data_product = DataProductModel(
+            ownerName=self.user.username,
+            replicaLocations=[DataReplicaLocationModel(
+                filePath=f"file://gateway.com:{legacy_path}",
+                replicaLocationCategory=(
+                    ReplicaLocationCategory.GATEWAY_DATA_STORE))])
+        # Unmigrated users are still found in the flat layout
+        self.assertTrue(user_storage.exists(self.request, data_product))
+
+        migrated = user_storage.migrate_user_layout()
+
+        self.assertEqual([self.user.username], migrated)
+        new_path = os.path.join(self.user_dir, "data", "foo.txt")
+        self.assertFalse(os.path.exists(legacy_user_dir))
+        self.assertTrue(os.path.isfile(new_path))
+        self.assertEqual(
+            new_path,
+            models.UserFiles.objects.get(file_dpu=self.product_uri).file_path)
+        self.assertEqual(
+            new_path, models.DataProductOutbox.objects.get().file_path)
+        # Replica paths registered before the migration still work
+        self.assertTrue(user_storage.exists(self.request, data_product))
+        user_storage.delete(self.request, data_product)
+        self.assertFalse(os.path.exists(new_path))
+        self.assertFalse(models.UserFiles.objects.exists())
+        self.assertEqual(
+            [self.user.username], user_storage._Datastore().list_usernames())
+
+
+@override_settings(GATEWAY_DATA_PRODUCT_REGISTRATION_WRITE_BEHIND=True)
+class WriteBehindRegistrationTests(TmpDataStoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.airavata_client = LocalAiravataClient()
+        self.request.airavata_client = self.airavata_client
+
+    def _save(self):
+        file = io.StringIO("Foo file")
+        file.name = "foo.txt"
+        return user_storage.save(self.request, "", file)
+
+    def test_save_returns_provisional_uri(self):
+        self.airavata_client.available = False
+
+        data_product = self._save()
+
+        self.assertTrue(data_product.productUri.startswith(
+            user_storage.PROVISIONAL_DATA_PRODUCT_URI_PREFIX))
+        self.assertEqual({}, self.airavata_client.data_products)
+        self.assertEqual(
+            data_product.productUri,
+            user_storage.user_file_exists(self.request, "foo.txt"))
+        self.assertIsNone(user_storage.resolve_data_product_uri(
+            self.request, data_product.productUri))
+
+    def test_register_pending_data_products(self):
+        data_product = self._save()
+
+        registered = user_storage.register_pending_data_products(
+            self.airavata_client, "dummy")
+
+        self.assertEqual(1, registered)
+        product_uri = user_storage.user_file_exists(self.request, "foo.txt")
+        self.assertNotEqual(data_product.productUri, product_uri)
+        self.assertEqual(
+            product_uri,
+            user_storage.resolve_data_product_uri(
+                self.request, data_product.productUri))
+        registered_data_product = self.airavata_client.getDataProduct(
+            "dummy", product_uri)
+        self.assertEqual("foo.txt", registered_data_product.productName)
+        self.assertEqual(
+            data_product.replicaLocations[0].filePath,
+            registered_data_product.replicaLocations[0].filePath)
+        self.assertEqual(0, user_storage.register_pending_data_products(
+            self.airavata_client, "dummy"))
+
+    def test_register_pending_data_products_retries_with_backoff(self):
+        data_product = self._save()
+        self.airavata_client.available = False
+
+        registered = user_storage.register_pending_data_products(
+            self.airavata_client, "dummy")
+
+        self.assertEqual(0, registered)
+        entry = models.DataProductOutbox.objects.get(
+            provisional_uri=data_product.productUri)
+        self.assertEqual(1, entry.attempts)
+        self.assertIn("unavailable", entry.last_error)
+        # Not retried until the retry delay has passed
+        self.airavata_client.available = True
+        self.assertEqual(0, user_storage.register_pending_data_products(
+            self.airavata_client, "dummy"))
+        models.DataProductOutbox.objects.update(
+            next_attempt_time=entry.next_attempt_time - timedelta(minutes=1))
+        self.assertEqual(1, user_storage.register_pending_data_products(
+            self.airavata_client, "dummy"))
+
+    def test_register_pending_data_products_after_many_attempts(self):
+        data_product = self._save()
+        models.DataProductOutbox.objects.update(attempts=50)
+        self._save()
+        self.airavata_client.available = False
+
+        registered = user_storage.register_pending_data_products(
+            self.airavata_client, "dummy", max_attempts=100)
+
+        self.assertEqual(0, registered)
+        entry = models.DataProductOutbox.objects.get(
+            provisional_uri=data_product.productUri)
+        self.assertEqual(51, entry.attempts)
+        # Second entry in the batch was still attempted
+        self.assertEqual(2, models.DataProductOutbox.objects.filter(
+            last_error__contains="unavailable").count())
+
+    def test_register_pending_data_products_stops_at_max_attempts(self):
+        self._save()
+        models.DataProductOutbox.objects.update(attempts=20)
+
+        registered = user_storage.register_pending_data_products(
+            self.airavata_client, "dummy", max_attempts=20)
+
+        self.assertEqual(0, registered)
+        self.assertEqual({}, self.airavata_client.data_products)
+
+    def test_register_pending_data_products_purges_old_entries(self):
+        data_product = self._save()
+        user_storage.register_pending_data_products(
+            self.airavata_client, "dummy")
+        models.DataProductOutbox.objects.update(
+            registered_time=timezone.now() - timedelta(days=8))
+
+        user_storage.register_pending_data_products(
+            self.airavata_client, "dummy")
+
+        self.assertFalse(models.DataProductOutbox.objects.exists())
+        self.assertIsNone(user_storage.resolve_data_product_uri(
+            self.request, data_product.productUri))
+        self.assertIsNotNone(
+            user_storage.user_file_exists(self.request, "foo.txt"))
+
+
+@override_settings(FILE_UPLOAD_DIRECTORY_PERMISSIONS=0o755)
+class StorageUsageTests(TmpDataStoreTestCase):
+
+    def _save(self, path, content, name="foo.txt"):
+        file = io.BytesIO(content)
+        file.name = name
+        self.request.airavata_client.registerDataProduct.return_value = \
+            f"airavata-dp://{uuid.uuid4()}"
+        return user_storage.save(self.request, path, file)
+
+    def test_usage_updated_by_writes(self):
+        self._save("", b"x" * 10)
+        self._save("data/sub", b"x" * 20)
+        data_product = self._save("data", b"x" * 30)
+        self.assertDictEqual(
+            {"": 10, "data": 50}, user_storage.get_storage_usage(self.request))
+
+        user_storage.delete(self.request, data_product)
+        self.assertDictEqual(
+            {"": 10, "data": 20}, user_storage.get_storage_usage(self.request))
+
+        user_storage.delete_dir(self.request, "data/sub")
+        self.assertDictEqual(
+            {"": 10}, user_storage.get_storage_usage(self.request))
+
+    def test_reconcile_storage_usage(self):
+        self._save("data", b"x" * 30)
+        with open(os.path.join(
+                self.tmpdir.name, self.user.username, "data", "bar"), 'wb') as f:
+            f.write(b"x" * 5)
+        models.UserStorageUsage.objects.all().delete()
+
+        user_storage.reconcile_storage_usage()
+
+        self.assertDictEqual(
+            {"data": 35}, user_storage.get_storage_usage(self.request))
+
+    @override_settings(GATEWAY_USER_STORAGE_QUOTA=100)
+    def test_quota(self):
+        self._save("", b"x" * 60)
+        with self.assertRaises(user_storage.StorageQuotaExceeded):
+            self._save("", b"x" * 60, name="bar.txt")
+        self.assertFalse(os.path.exists(os.path.join(
+            self.tmpdir.name, self.user.username, "bar.txt")))
+
+        external_path = os.path.join(self.tmpdir.name, "external.txt")
+        with open(external_path, 'wb') as f:
+            f.write(b"x" * 60)
+        with self.assertRaises(user_storage.StorageQuotaExceeded):
+            user_storage.move_from_filepath(
+                self.request, external_path, "data")
+        self.assertTrue(os.path.exists(external_path))
+        self.assertDictEqual(
+            {"": 60}, user_storage.get_storage_usage(self.request))